@@ -1,11 +1,39 @@
 import requests
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
-import copy
 import yaml
-from collections import OrderedDict
-import re
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+try:
+    import re2 as _re
+except ImportError:
+    import re as _re
+import os
 from io import BytesIO
 from datetime import datetime
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from xml.sax.saxutils import escape
+
+# CORS token embedded in vendor.js, compiled once rather than per get_token.
+# Uses google-re2's linear time matcher when it is installed.
+_TOKEN_RE = _re.compile(r'STR_AJAX_VALUE\s*=\s*"([^"]*)"')
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>"
+
+# Error code returned by the modem when the CORS token is stale.
+TOKEN_ERROR_CODE = '125001'
+
+# Size of the session's connection pool to the modem, and so the most
+# requests sent to it at once.
+MAX_CONNECTIONS = 4
+
+# Parsed yml configs keyed by (filename, mtime). Shared between instances,
+# so treat the cached dicts as read-only.
+_CFG_CACHE = {}
 
 class HTTPStatus(Exception):
     pass
@@ -15,6 +43,8 @@ class APIError(Exception):
 
 
 class APIRequest(object):
+    __slots__ = ('req_fun', 'url', 'kwargs')
+
     def __init__(self, req_fun, url, **kwargs):
         self.req_fun = req_fun
         self.url = url
@@ -25,14 +55,39 @@ class APIRequest(object):
 class HuaweiAPI(object):
 
     def __init__(self, filename = 'huawei-K4203-api.yml'):
-        self.cfg_dict = yaml.load(open(filename,'r').read())
+        self.cfg_dict = load_config(filename)
         self.common_headers = self.cfg_dict['common']['headers']
-        self.error_codes = self.cfg_dict['common']['error-codes']
+        # The yml keys load as ints but codes in responses are strings,
+        # so key everything by string.
+        self.error_codes = MappingProxyType(
+            {str(k): v for k, v in self.cfg_dict['common']['error-codes'].items()})
         self.base_url = 'http://' + self.common_headers['Host']
-        self.api_dict = {k: v for k, v in self.cfg_dict.items() if not k == 'common-headers'}
+        self.api_dict = {k: v for k, v in self.cfg_dict.items() if k != 'common'}
+        self._token = None
+        self._token_lock = threading.Lock()
+        # Keep connections to the modem alive between commands.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONNECTIONS)
+        self.session.mount('http://', adapter)
+        # Preserialized default fields of each post request.
+        self._templates = {}
+        for name, cmd_dict in self.api_dict.items():
+            if cmd_dict.get('method') == 'post':
+                self._templates[name] = build_template(cmd_dict['request'])
 
 
     def get_token(self):
+        '''
+        Return the CORS token, fetching it from the modem on first use.
+        If the modem rejects a token, _run drops it via _clear_token, but
+        only while it is still the cached one.
+        '''
+        with self._token_lock:
+            if self._token is None:
+                self._token = self._fetch_token()
+            return self._token
+
+    def _fetch_token(self):
         '''
         Extract CORS token from vendor.js as the endpoints that work
         on other modems seem to be absent on the K4203.
@@ -40,30 +95,32 @@ class HuaweiAPI(object):
         This seems to be the thing that changes most between models.
         Some do not require a token.
         '''
-        vendor = requests.get(self.base_url + "/html/js/vendor.js")
+        vendor = self.session.get(self.base_url + "/html/js/vendor.js")
         if vendor.status_code == 200:
-            token = re.search('(?<=STR_AJAX_VALUE)\s*=\s\"(.*)\".*\n', vendor.text).group(1)
+            token = _TOKEN_RE.search(vendor.content.decode('ascii', 'ignore')).group(1)
         else:
             raise HTTPStatus
         
         return token
 
     def list_requests(self):
-        return [x for x in self.api_dict]
+        return list(self.api_dict)
 
     def get_error(self, code):
         '''
         Return string for Huawei's custom error code.
+        The code may be given as an int or a string.
         Note that the values packaged in k4203.yml are not comprehensive.
         '''
-        error_str = self.error_codes.get(code, "No such error code.")
+        error_str = self.error_codes.get(str(code), "No such error code.")
         return error_str
 
-    def make_request(self, name, **kwargs):
+    def make_request(self, name, token=None, **kwargs):
         '''
         Copy request from api and generate xml.
         Fields are defaulted to what is found in the loaded yml file.
         They can be overridden with kwargs.
+        Post requests use token if given, otherwise the cached one.
         Example:
         >>>self.run_command('sms', Content="Example",
                        Length=7,
@@ -73,30 +130,32 @@ class HuaweiAPI(object):
         '''
         if name not in self.api_dict:
             raise APIError
-        cmd_dict = copy.deepcopy(self.api_dict.get(name))
+        # Templates are shared with the config cache, so only copy what
+        # gets modified below.
+        cmd_dict = self.api_dict[name]
         url = self.base_url + cmd_dict['url']
         xml_str = ''
-        headers = copy.deepcopy(self.common_headers)
+        headers = dict(self.common_headers)
         method = cmd_dict['method']
         if method == 'post':
-            # Modem responds with error if XML is reordered.
-            request = OrderedDict(cmd_dict['request'])
+            # Modem responds with error if XML is reordered; dicts keep
+            # insertion order.
+            request = dict(cmd_dict['request'])
             if cmd_dict.get('Referer'):
                 headers['Referer'] = cmd_dict['Referer']
-            request['token'] = self.get_token()
+            request['token'] = token if token is not None else self.get_token()
             # Todo: The xml can have multiple values with the same tag
             # such as phones. Dictionaries are not the best structure for this.
             for key, value in kwargs.items():
                 if key in request:
-                    if type(value) == dict:
+                    if isinstance(value, dict):
                         request[key] = value
                     else:
                         request[key] = str(value)
-            xml_str = ET.tostring(dict_to_xml('request', request))
-            xml_str = b"<?xml version='1.0' encoding='UTF-8'?>" + xml_str
-            return APIRequest(requests.post, url, headers=headers, data = xml_str)
+            xml_str = serialize_request(self._templates[name], request)
+            return APIRequest(self.session.post, url, headers=headers, data = xml_str)
         elif method == 'get':
-            return APIRequest(requests.get, url)
+            return APIRequest(self.session.get, url)
 
     def run_command(self, name, **kwargs):
         '''
@@ -104,9 +163,35 @@ class HuaweiAPI(object):
         provided in yml.
         Anything provided in kwargs will override defaults.
         '''
-        req = self.make_request(name, **kwargs)
-        response = req.run()
+        response = self._run(name, **kwargs)[0]
         return response.status_code, response_to_dict(response)
+
+    def _run(self, name, token=None, **kwargs):
+        '''
+        Send command and return the raw response with the code of any
+        <error> body, refetching the token and retrying once if the
+        modem rejects the one that was sent.
+        '''
+        # Pin the token so a rejected one can be told apart from one
+        # another thread has since refreshed.
+        if token is None and name in self._templates:
+            token = self.get_token()
+        response = self.make_request(name, token=token, **kwargs).run()
+        code = response_error_code(response)
+        if token is not None and code == TOKEN_ERROR_CODE:
+            self._clear_token(token)
+            response = self.make_request(name, token=self.get_token(),
+                                         **kwargs).run()
+            code = response_error_code(response)
+        return response, code
+
+    def _clear_token(self, token):
+        '''
+        Drop the cached token if it is still the one that was rejected.
+        '''
+        with self._token_lock:
+            if self._token == token:
+                self._token = None
  
     def send_sms(self, content, number):
         '''Send sms to numbers
@@ -119,7 +204,7 @@ class HuaweiAPI(object):
         length = len(content) + 1
 
         # Datetime in iso format
-        date_str = datetime.now().replace(microsecond=0).isoformat()
+        date_str = datetime.now().isoformat(timespec='seconds')
 
         return self.run_command('sms', Content=content,
                                        Length=length,
@@ -134,35 +219,77 @@ class HuaweiAPI(object):
         >>> api.get_inbox()
         [{'SaveType': '4', 'Priority': '0', 'Smstat': '0', 'Date': '2017-08-22 16:39:25', 'Index': '40007', 'Phone': '+61123456789', 'Content': 'Test', 'SmsType': '1', 'Sca': None}]
         '''
-        response = self.run_command('sms-list')
-        if response[0] == 200:
-            message_dict = response[1]['response'].get('Messages')
-            if type(message_dict) == dict:
-                messages = message_dict.get('Message')
-                # If we have a single message it doesn't come in a list
-                if type(messages) != list:
-                    messages = [messages]
-                return messages
-            else:
-                return []
+        response, code = self._run('sms-list')
+        if response.status_code == 200:
+            # Errors come back with a 200 status and an <error> body.
+            if code is not None:
+                raise APIError(code)
+            return list(iter_messages(response))
         else:
             raise HTTPStatus
 
-    def clear_inbox(self):
+    def clear_inbox(self, max_workers=MAX_CONNECTIONS):
         '''
-        Iterate over messages in inbox and delete them.
+        Delete all messages in the inbox.
+        Deletions are sent concurrently over at most max_workers
+        connections, capped at the session's MAX_CONNECTIONS.
         '''
         inbox = self.get_inbox()
-        responses = []
-        for message in inbox:
-            idx = message.get('Index')
-            response = self.run_command('sms-delete', Index=idx)
-            responses.append(response)
-        return responses
-        
+        max_workers = min(max_workers, MAX_CONNECTIONS)
+        def delete(message):
+            return self.run_command('sms-delete', Index=message.get('Index'))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(delete, inbox))
+
+
+def load_config(filename):
+    '''
+    Parse the api yml file, reusing the previous result if the file
+    has not been modified since it was last loaded.
+    '''
+    key = (filename, os.path.getmtime(filename))
+    cfg_dict = _CFG_CACHE.get(key)
+    if cfg_dict is None:
+        with open(filename, 'r') as f:
+            cfg_dict = yaml.load(f, Loader=_Loader)
+        _CFG_CACHE[key] = cfg_dict
+    return cfg_dict
 
 def response_to_dict(r):
-    return etree_to_dict(ET.fromstring(r.text))
+    return etree_to_dict(ET.fromstring(r.content))
+
+def response_error_code(r):
+    '''
+    Return the code of an <error> response as a string, or None for any
+    other response. Parsing stops at the root element if it is not an error.
+    '''
+    context = ET.iterparse(BytesIO(r.content), events=('start', 'end'))
+    try:
+        event, root = next(context)
+        if root.tag != 'error':
+            return None
+        for event, elem in context:
+            if event == 'end' and elem.tag == 'code':
+                return elem.text
+    except ET.ParseError:
+        pass
+    return None
+
+def iter_messages(r):
+    '''
+    Incrementally parse an sms-list response, yielding a dictionary per
+    <Message>. Each message element is discarded once converted so memory
+    use does not grow with the size of the inbox.
+    '''
+    messages = None
+    for event, elem in ET.iterparse(BytesIO(r.content), events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'Messages':
+                messages = elem
+        elif elem.tag == 'Message':
+            yield etree_to_dict(elem)['Message']
+            if messages is not None:
+                messages.clear()
 
 def etree_to_dict(element_tree):
     """Traverse the given XML element tree to convert it into a dictionary.
@@ -173,37 +300,31 @@ def etree_to_dict(element_tree):
 
     Credit Eric Scrivener
     """
-    def internal_iter(tree, accum):
-        """Recursively iterate through the elements of the tree accumulating
-        a dictionary result.
- 
-        :param tree: The XML element tree
-        :type tree: xml.etree.ElementTree
-        :param accum: Dictionary into which data is accumulated
-        :type accum: dict
-        :rtype: dict
-        """
-        if tree is None:
-            return accum
- 
-        if tree.getchildren():
-            accum[tree.tag] = {}
-            for each in tree.getchildren():
-                result = internal_iter(each, {})
-                if each.tag in accum[tree.tag]:
-                    if not isinstance(accum[tree.tag][each.tag], list):
-                        accum[tree.tag][each.tag] = [
-                            accum[tree.tag][each.tag]
-                        ]
-                    accum[tree.tag][each.tag].append(result[each.tag])
-                else:
-                    accum[tree.tag].update(result)
-        else:
-            accum[tree.tag] = tree.text
- 
-        return accum
- 
-    return internal_iter(element_tree, {})
+    if element_tree is None:
+        return {}
+
+    # Walk the tree with an explicit stack of (element, dict to fill).
+    # Child dictionaries are inserted before they are filled, so sibling
+    # order is kept without recursion.
+    def value_of(elem):
+        return {} if len(elem) else elem.text
+
+    result = {element_tree.tag: value_of(element_tree)}
+    stack = [(element_tree, result[element_tree.tag])] if len(element_tree) else []
+    while stack:
+        tree, accum = stack.pop()
+        for each in tree:
+            value = value_of(each)
+            if len(each):
+                stack.append((each, value))
+            if each.tag in accum:
+                if not isinstance(accum[each.tag], list):
+                    accum[each.tag] = [accum[each.tag]]
+                accum[each.tag].append(value)
+            else:
+                accum[each.tag] = value
+
+    return result
 
 
 def dict_to_xml(tag, d):
@@ -212,13 +333,50 @@ def dict_to_xml(tag, d):
     '''
     elem = ET.Element(tag)
     for key, value in d.items():
-        if type(value) == dict:
+        if isinstance(value, dict):
             child = dict_to_xml(key, value)
         else:
             child = ET.Element(key)
             child.text = str(value)
         elem.append(child)
     return elem
+
+def field_to_bytes(key, value):
+    '''
+    Serialize a single request field, recursing into dictionaries.
+    Produces the same markup as dict_to_xml without building elements.
+    '''
+    if isinstance(value, dict):
+        text = b''.join(field_to_bytes(k, v) for k, v in value.items())
+    else:
+        # Non-ASCII goes out as character references, as ET.tostring does.
+        text = escape(str(value)).encode('ascii', 'xmlcharrefreplace')
+    tag = key.encode('utf-8')
+    return b'<' + tag + b'>' + text + b'</' + tag + b'>'
+
+def build_template(request):
+    '''
+    Preserialize the default fields of a request from the yml.
+    Returns a dictionary mapping field name to (default value, bytes).
+    '''
+    return {key: (value, field_to_bytes(key, value))
+            for key, value in dict(request).items()}
+
+def serialize_request(template, request):
+    '''
+    Serialize a request dictionary to an xml document.
+    Fields still holding their default value reuse the bytes prebuilt
+    by build_template.
+    '''
+    parts = [XML_DECLARATION, b'<request>']
+    for key, value in request.items():
+        default = template.get(key)
+        if default is not None and default[0] is value:
+            parts.append(default[1])
+        else:
+            parts.append(field_to_bytes(key, value))
+    parts.append(b'</request>')
+    return b''.join(parts)
     
 def tree_to_string(tree):
     pass